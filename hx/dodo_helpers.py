@@ -7,8 +7,16 @@ import shutil
 import tempfile
 import subprocess
 import uuid
+import fcntl
+import stat
+import errno
+import hashlib
+import threading
+import http.client
+import urllib.parse
 import time
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from doit.action import CmdAction
 from pathlib import *
 from distutils.version import LooseVersion
@@ -59,6 +67,77 @@ def nvmUse(version):
     else:
         return "export NVM_DIR=$HOME/.nvm && source $NVM_DIR/nvm.sh && nvm install {}".format(version)
 
+def nvmDir():
+    return os.environ.get('NVM_DIR') or os.path.join(os.environ['HOME'], '.nvm')
+
+def nvmScript():
+    """
+    Return the path to nvm.sh, or None if nvm is not installed
+    """
+    candidates = [
+        os.path.join(nvmDir(), 'nvm.sh'),
+        '/usr/local/opt/nvm/nvm.sh',
+        '/opt/homebrew/opt/nvm/nvm.sh',
+    ]
+    for path in candidates:
+        if os.path.isfile(path):
+            return path
+    return None
+
+def nvmVersion():
+    """
+    Return the version of the installed nvm, read from its files
+    without spawning a shell
+    """
+    script = nvmScript()
+    if not script:
+        return None
+    with open(script) as f:
+        match = re.search(r'"--version"[^\n]*\n\s*(?:nvm_)?echo\s+[\'"]v?([0-9]+\.[0-9]+\.[0-9]+)', f.read())
+    if match:
+        return match.group(1)
+    try:
+        with open(os.path.join(os.path.dirname(script), 'package.json')) as f:
+            return json.load(f).get('version')
+    except (OSError, ValueError):
+        return None
+
+def nvmNodeVersions():
+    """
+    Return the node versions installed by nvm, oldest first
+    """
+    versions = []
+    try:
+        with os.scandir(os.path.join(nvmDir(), 'versions', 'node')) as it:
+            for entry in it:
+                if entry.is_dir() and os.path.isfile(os.path.join(entry.path, 'bin', 'node')):
+                    versions.append(entry.name.lstrip('v'))
+    except OSError:
+        pass
+    return sorted(versions, key=LooseVersion)
+
+def nvmNodePath(version):
+    """
+    Return the absolute path of the newest installed node binary matching
+    version (eg "8", "8.9" or "v8.9.4", or "node" for the latest), or None
+    """
+    spec = str(version).lstrip('v').split('.')
+    matches = [v for v in nvmNodeVersions() if version == 'node' or v.split('.')[:len(spec)] == spec]
+    if not matches:
+        return None
+    return os.path.join(nvmDir(), 'versions', 'node', 'v' + matches[-1], 'bin', 'node')
+
+def nvmUseDirect(version):
+    """
+    Return a shell command that will put the given node version on the path,
+    resolving the installed version directly rather than sourcing nvm. Falls
+    back to nvmUse if the version is not yet installed.
+    """
+    nodepath = nvmNodePath(version)
+    if nodepath is None:
+        return nvmUse(version)
+    return 'export PATH="{}:$PATH"'.format(os.path.dirname(nodepath))
+
 def requireFile(path):
     def action():
         if not os.path.isfile(path):
@@ -86,6 +165,93 @@ def uploadSourceMapToRollbar(rollbartoken, codeversion, minifiedurl, sourcemapfi
         '-F', 'source_map=@{}'.format(str(sourcemapfile))
     ])
 
+ROLLBAR_SOURCEMAP_URL = 'https://api.rollbar.com/api/1/sourcemap'
+
+def uploadSourceMapsToRollbar(rollbartoken, codeversion, sourcemaps, manifestfile, endpoint=ROLLBAR_SOURCEMAP_URL, workers=8):
+    """
+    Upload many source maps to rollbar concurrently, reusing a http
+    connection per worker. sourcemaps is a list of (minifiedurl, sourcemapfile)
+    pairs. Maps whose content has already been uploaded for this codeversion
+    (as recorded in the json manifestfile) are skipped. Returns the minified
+    urls that were uploaded.
+    """
+    manifest = {}
+    if os.path.isfile(str(manifestfile)):
+        with open(str(manifestfile)) as f:
+            manifest = json.load(f)
+    uploaded = manifest.setdefault(codeversion, {})
+
+    pending = []
+    for minifiedurl, sourcemapfile in sourcemaps:
+        with open(str(sourcemapfile), 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if uploaded.get(minifiedurl) != digest:
+            pending.append( (minifiedurl, sourcemapfile, content, digest) )
+
+    url = urllib.parse.urlsplit(endpoint)
+    local = threading.local()
+    conns = []
+
+    def post(body, headers):
+        for attempt in range(2):
+            if getattr(local, 'conn', None) is None:
+                if url.scheme == 'https':
+                    local.conn = http.client.HTTPSConnection(url.netloc, timeout=60)
+                else:
+                    local.conn = http.client.HTTPConnection(url.netloc, timeout=60)
+                conns.append(local.conn)
+            try:
+                local.conn.request('POST', url.path or '/', body, headers)
+                resp = local.conn.getresponse()
+                return resp.status, resp.read()
+            except (http.client.HTTPException, ConnectionError):
+                # The server may have closed an idle keep-alive connection
+                local.conn.close()
+                local.conn = None
+                if attempt:
+                    raise
+
+    def upload(minifiedurl, sourcemapfile, content, digest):
+        boundary = uuid.uuid4().hex
+        parts = []
+        for name, value in [('access_token', rollbartoken), ('version', codeversion), ('minified_url', minifiedurl)]:
+            parts.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(boundary, name, value).encode('utf-8'))
+        parts.append('--{}\r\nContent-Disposition: form-data; name="source_map"; filename="{}"\r\nContent-Type: application/octet-stream\r\n\r\n'.format(boundary, Path(str(sourcemapfile)).name).encode('utf-8'))
+        parts.append(content)
+        parts.append('\r\n--{}--\r\n'.format(boundary).encode('utf-8'))
+        body = b''.join(parts)
+        status, respbody = post(body, {
+            'Content-Type': 'multipart/form-data; boundary={}'.format(boundary),
+            'Content-Length': str(len(body)),
+        })
+        if status != 200:
+            raise RuntimeError('Failed to upload source map for {} ({}): {}'.format(minifiedurl, status, respbody.decode('utf-8', 'replace')))
+        return minifiedurl, digest
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(upload, *p) for p in pending]:
+            try:
+                minifiedurl, digest = future.result()
+                uploaded[minifiedurl] = digest
+            except Exception as e:
+                errors.append(e)
+    for conn in conns:
+        conn.close()
+
+    # Record the successful uploads, even if some failed
+    os.makedirs(os.path.dirname(os.path.abspath(str(manifestfile))), exist_ok=True)
+    tmpfile = '{}.{}'.format(manifestfile, uuid.uuid4())
+    with open(tmpfile, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmpfile, str(manifestfile))
+
+    if errors:
+        raise errors[0]
+    print( "Uploaded {} source maps to rollbar ({} unchanged)".format(len(pending), len(sourcemaps) - len(pending)) )
+    return [p[0] for p in pending]
+
 class DockerImageRef(object):
     """
     The name of a docker image, both locally and once pushed
@@ -122,17 +288,19 @@ class DockerContext(object):
         """
         self.items.append( (DockerContext.FILE_CONTENT, content, dest) )
 
-    def tree(self, srcdir, destdir):
+    def tree(self, srcdir, destdir, exclude=()):
         """
-        Add a recursive tree to the context
+        Add a recursive tree to the context. exclude is a list of
+        .dockerignore style patterns, relative to srcdir.
         """
-        self.items.append( (DockerContext.TREE, srcdir, destdir) )
+        self.items.append( (DockerContext.TREE, srcdir, destdir, ExcludeRules(exclude)) )
 
-    def ziptree(self, zipfile, destdir):
+    def ziptree(self, zipfile, destdir, exclude=()):
         """
-        Unpack a zipfile into the context
+        Unpack a zipfile into the context. exclude is a list of
+        .dockerignore style patterns, relative to the zip root.
         """
-        self.items.append( (DockerContext.ZIPTREE, zipfile, destdir) )
+        self.items.append( (DockerContext.ZIPTREE, zipfile, destdir, ExcludeRules(exclude)) )
 
     def file_dep(self):
         files = []
@@ -142,40 +310,268 @@ class DockerContext(object):
             elif item[0] == DockerContext.FILE_CONTENT:
                 pass
             elif item[0] == DockerContext.TREE:
-                files += rglobfiles( item[1])
+                files += item[3].files(item[1])
             elif item[0] == DockerContext.ZIPTREE:
                 files.append(item[1])
             else:
                 raise RuntimeError( "Unknown context type: " + item[0] )
         return files
 
+    def sizeReport(self):
+        """
+        Return a list of (description, filecount, bytes) for each item,
+        largest first, showing which inputs dominate the context
+        """
+        report = []
+        for item in self.items:
+            if item[0] == DockerContext.FILE:
+                sizes = [os.path.getsize(str(item[1]))]
+            elif item[0] == DockerContext.FILE_CONTENT:
+                sizes = [len(str(item[1]).encode('utf-8'))]
+            elif item[0] == DockerContext.TREE:
+                sizes = [os.path.getsize(str(f)) for f in item[3].files(item[1])]
+            elif item[0] == DockerContext.ZIPTREE:
+                with zipfile.ZipFile(str(item[1])) as zf:
+                    sizes = [zi.file_size for zi in zf.infolist() if not zi.is_dir() and not item[3].excludes(zi.filename)]
+            else:
+                raise RuntimeError( "Unknown context type: " + item[0] )
+            desc = "{} {} -> {}".format(item[0], item[1] if item[0] != DockerContext.FILE_CONTENT else '<content>', item[2])
+            report.append( (desc, len(sizes), sum(sizes)) )
+        report.sort(key=lambda r: r[2], reverse=True)
+        return report
+
+    def printSizeReport(self):
+        report = self.sizeReport()
+        for desc, count, size in report:
+            print( "{:>12} bytes {:>8} files  {}".format(size, count, desc) )
+        print( "{:>12} bytes {:>8} files  total".format(sum(r[2] for r in report), sum(r[1] for r in report)) )
+
     def copyTo(self,ctxDir):
+        """
+        Assemble the context into ctxDir, returning the number of bytes
+        actually copied. Files are hard linked or reflinked where possible,
+        and the work is spread across a thread pool.
+        """
+        # Expand the items, in order, into one operation per destination
+        # so that later items still override earlier ones and every
+        # destination is written exactly once
+        ops = {}
+        dirs = set()
         for item in self.items:
             if item[0] == DockerContext.FILE:
-                destfile = ctxDir/item[2]
-                os.makedirs( str(destfile.parent), exist_ok=True)
-                shutil.copyfile(str(item[1]), str(ctxDir/item[2]))
+                ops[ctxDir/item[2]] = (DockerContext.FILE, item[1])
             elif item[0] == DockerContext.FILE_CONTENT:
-                destfile = ctxDir/item[2]
-                os.makedirs( str(destfile.parent), exist_ok=True)
-                with open(destfile,'w') as f:
-                    f.write( str(item[1]))
+                ops[ctxDir/item[2]] = (DockerContext.FILE_CONTENT, item[1])
             elif item[0] == DockerContext.TREE:
-                shutil.copytree(str(item[1]), str(ctxDir/item[2]))
+                srcdirs, srcfiles = item[3].walk(item[1])
+                dirs.add(ctxDir/item[2])
+                dirs.update(ctxDir/item[2]/d.relative_to(item[1]) for d in srcdirs)
+                for srcfile in srcfiles:
+                    ops[ctxDir/item[2]/srcfile.relative_to(item[1])] = (DockerContext.FILE, srcfile)
             elif item[0] == DockerContext.ZIPTREE:
-                destdir = ctxDir/item[2]
-                os.makedirs(str(destdir), exist_ok=True)
-                subprocess.run('unzip -d {} {}'.format(destdir, item[1]), check=True, shell=True)
+                dirs.add(ctxDir/item[2])
+                with zipfile.ZipFile(str(item[1])) as zf:
+                    for zinfo in zf.infolist():
+                        if item[3].excludes(zinfo.filename):
+                            continue
+                        dest = ctxDir/item[2]/zipMemberPath(zinfo.filename)
+                        if zinfo.is_dir():
+                            dirs.add(dest)
+                        else:
+                            ops[dest] = (DockerContext.ZIPTREE, item[1], zinfo)
             else:
                 raise RuntimeError( "Unknown context type: " + item[0] )
 
+        for destdir in dirs | set(dest.parent for dest in ops):
+            os.makedirs(str(destdir), exist_ok=True)
+
+        zipentries = {}
+        with ThreadPoolExecutor(max_workers=CONTEXT_COPY_WORKERS) as pool:
+            futures = []
+            for dest, op in ops.items():
+                if op[0] == DockerContext.FILE:
+                    futures.append(pool.submit(placeFile, op[1], dest))
+                elif op[0] == DockerContext.FILE_CONTENT:
+                    removeExisting(dest)
+                    with open(str(dest),'w') as f:
+                        f.write( str(op[1]))
+                else:
+                    zipentries.setdefault(op[1], []).append( (op[2], dest) )
+            futures += [pool.submit(unpackZipEntries, zippath, entries) for zippath, entries in zipentries.items()]
+            return sum(f.result() for f in futures)
+
+CONTEXT_COPY_WORKERS = 8
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+def removeExisting(path):
+    """
+    Unlink path if it exists, so that a subsequent write can never go
+    through a hard link into another file
+    """
+    if os.path.lexists(str(path)):
+        os.unlink(str(path))
+
+def placeFile(src, dest):
+    """
+    Place a copy of src at dest, preferring a hard link, then a reflink,
+    and finally a real copy. Returns the number of bytes copied.
+    """
+    removeExisting(dest)
+    try:
+        os.link(str(src), str(dest))
+        return 0
+    except OSError:
+        pass
+    with open(str(src), 'rb') as fsrc, open(str(dest), 'wb') as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+            shutil.copymode(str(src), str(dest))
+            return 0
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF, errno.EPERM):
+                raise
+        shutil.copyfileobj(fsrc, fdest)
+    shutil.copymode(str(src), str(dest))
+    return os.path.getsize(str(dest))
+
+def zipMemberPath(name):
+    """
+    Return the relative path for a zip member, dropping any absolute
+    or parent directory components (as unzip does)
+    """
+    return Path(*[p for p in name.split('/') if p not in ('', '.', '..')])
+
+def unpackZipEntries(zippath, entries):
+    """
+    Unpack the given (zipinfo, dest) entries from a zipfile, preserving
+    unix file modes and symlinks. Returns the number of bytes written.
+    """
+    written = 0
+    with zipfile.ZipFile(str(zippath)) as zf:
+        for zinfo, dest in entries:
+            removeExisting(dest)
+            mode = zinfo.external_attr >> 16
+            if stat.S_ISLNK(mode):
+                os.symlink(zf.read(zinfo).decode('utf-8'), str(dest))
+                continue
+            with zf.open(zinfo) as fsrc, open(str(dest), 'wb') as fdest:
+                shutil.copyfileobj(fsrc, fdest)
+            if mode:
+                os.chmod(str(dest), mode & 0o7777)
+            written += zinfo.file_size
+    return written
+
+class ExcludeRules(object):
+    """
+    A set of .dockerignore style exclude patterns. Patterns are matched
+    against slash separated paths relative to the root, support * ? and
+    **, exclude everything beneath a matching directory, and may be
+    negated with a leading !. The last matching pattern wins.
+    """
+    def __init__(self, patterns):
+        self.rules = []
+        for pattern in patterns:
+            negate = pattern.startswith('!')
+            pattern = pattern[1:] if negate else pattern
+            pattern = pattern.strip().strip('/')
+            if pattern:
+                self.rules.append( (negate, re.compile(excludePatternRegex(pattern))) )
+        self.hasNegations = any(negate for negate,_ in self.rules)
+
+    def excludes(self, relpath):
+        parts = [p for p in str(relpath).split('/') if p and p != '.']
+        excluded = False
+        for negate, regex in self.rules:
+            # A pattern matching a parent directory excludes its contents
+            if any(regex.match('/'.join(parts[:i]) + '/') for i in range(1, len(parts)+1)):
+                excluded = not negate
+        return excluded
+
+    def files(self, srcdir):
+        """
+        Enumerate all of the files recursively at srcdir that are not excluded
+        """
+        return self.walk(srcdir)[1]
+
+    def walk(self, srcdir):
+        """
+        Return the (directories, files) recursively at srcdir that are not
+        excluded. Like shutil.copytree, symlinked directories are followed.
+        """
+        dirs = []
+        files = []
+        for dirpath, dirnames, filenames in os.walk(str(srcdir), followlinks=True):
+            reldir = Path(dirpath).relative_to(srcdir)
+            realdir = os.path.realpath(dirpath)
+            # Don't follow a symlink back into one of its own ancestors
+            dirnames[:] = [d for d in dirnames if not isAncestorOrSelf(os.path.realpath(os.path.join(dirpath, d)), realdir)]
+            if not self.hasNegations:
+                # Don't descend into excluded directories
+                dirnames[:] = [d for d in dirnames if not self.excludes((reldir/d).as_posix())]
+            dirs += [Path(dirpath)/d for d in dirnames if not self.excludes((reldir/d).as_posix())]
+            for f in filenames:
+                if os.path.isfile(os.path.join(dirpath, f)) and not self.excludes((reldir/f).as_posix()):
+                    files.append(Path(dirpath)/f)
+        return dirs, files
+
+def isAncestorOrSelf(path, of):
+    return of == path or of.startswith(path.rstrip(os.sep) + os.sep)
+
+def excludePatternRegex(pattern):
+    """
+    Translate an exclude pattern into a regex matching a path with a trailing /
+    """
+    regex = ''
+    for seg in pattern.split('/'):
+        if seg == '**':
+            regex += '(?:[^/]+/)*'
+            continue
+        i = 0
+        while i < len(seg):
+            c = seg[i]
+            if c == '*':
+                regex += '[^/]*'
+            elif c == '?':
+                regex += '[^/]'
+            elif c == '[' and excludePatternClass(seg, i):
+                j = seg.index(']', i+1)
+                regex += excludePatternClass(seg, i)
+                i = j
+            else:
+                regex += re.escape(c)
+            i += 1
+        regex += '/'
+    return regex + r'\Z'
+
+def excludePatternClass(seg, i):
+    """
+    Translate the [...] character class starting at seg[i] into a regex,
+    returning None if it is unterminated or empty (and so literal)
+    """
+    j = seg.find(']', i+1)
+    if j == -1:
+        return None
+    body = seg[i+1:j]
+    negate = body[:1] in ('!', '^')
+    if negate:
+        body = body[1:]
+    if not body:
+        return None
+    escaped = ''.join(c if c == '-' else re.escape(c) for c in body)
+    return '[' + ('^' if negate else '') + escaped + ']'
+
 class DockerImage(object):
     """
-    Manage the building of a docker image in a temporary directory
+    Manage the building of a docker image in a temporary directory.
+    If sizeReport is set, the size of each context item is printed
+    before building.
     """
-    def __init__( self, name, context):
+    def __init__( self, name, context, sizeReport=False):
         self.name = name
         self.context = context
+        self.sizeReport = sizeReport
         self.instructions = []
 
     def cmd(self, instruction):
@@ -189,9 +585,14 @@ class DockerImage(object):
         print( "Building image in " + str(ctxdir) )
 
         # Copy in the context
-        self.context.copyTo(ctxdir)
-
-        # Write a dockerfile
+        copied = self.context.copyTo(ctxdir)
+        if self.sizeReport:
+            self.context.printSizeReport()
+        print( "Context assembled ({} bytes copied)".format(copied) )
+
+        # Write a dockerfile (replacing, not writing through, any
+        # file linked in from the context)
+        removeExisting(ctxdir/'Dockerfile')
         with open(str(ctxdir/'Dockerfile'), 'w') as f:
             for inst in self.instructions:
                 f.write(inst + '\n')
@@ -243,12 +644,93 @@ class MarkerFile(object):
 class CheckException(Exception):
     pass
 
+class PathIndex(object):
+    """
+    An index of the commands available on a $PATH, built by
+    scanning each directory once
+    """
+    def __init__(self, pathvar):
+        self.pathvar = pathvar
+        self.entries = {}
+        for path in pathvar.split(os.pathsep):
+            path = path.strip('"')
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        self.entries.setdefault(entry.name, []).append(entry.path)
+            except OSError:
+                pass
+        self.resolved = {}
+
+    def findAll(self, command):
+        """
+        Return all executables for command, in $PATH order
+        """
+        if command not in self.resolved:
+            candidates = [command] if os.sep in command else self.entries.get(command, [])
+            self.resolved[command] = [p for p in candidates
+                                      if os.path.isfile(p) and os.access(p, os.X_OK)]
+        return self.resolved[command]
+
+    def find(self, command):
+        """
+        Return the executable for command that would be run, or None
+        """
+        paths = self.findAll(command)
+        return paths[0] if paths else None
+
+    def shadowed(self, command):
+        """
+        Return the executables for command hidden by an earlier $PATH
+        entry, ignoring those that are the same file
+        """
+        paths = self.findAll(command)
+        if not paths:
+            return []
+        seen = {os.path.realpath(paths[0])}
+        result = []
+        for p in paths[1:]:
+            rp = os.path.realpath(p)
+            if rp not in seen:
+                seen.add(rp)
+                result.append(p)
+        return result
+
+    def shadowedCommands(self):
+        """
+        Return a dict from command name to (path, shadowed paths) for every
+        command on $PATH that hides another version
+        """
+        result = {}
+        for command, paths in self.entries.items():
+            if len(paths) > 1:
+                shadowed = self.shadowed(command)
+                if shadowed:
+                    result[command] = (self.find(command), shadowed)
+        return result
+
+_pathIndex = None
+
+def getPathIndex():
+    """
+    Return the PathIndex for the current $PATH, built once per process
+    (and rebuilt only if $PATH changes)
+    """
+    global _pathIndex
+    pathvar = os.environ.get("PATH", "")
+    if _pathIndex is None or _pathIndex.pathvar != pathvar:
+        _pathIndex = PathIndex(pathvar)
+    return _pathIndex
+
 def getCommandPath(command):
-    for path in os.environ["PATH"].split(os.pathsep):
-        path = path.strip('"')
-        exe_file = os.path.join(path, command)
-        if os.path.isfile(exe_file) and os.access(exe_file, os.X_OK):
-            return exe_file
+    exe_file = getPathIndex().find(command)
+    if not exe_file:
+        # The command may have been installed since the index was built
+        global _pathIndex
+        _pathIndex = None
+        exe_file = getPathIndex().find(command)
+    if exe_file:
+        return exe_file
     raise CheckException("Unable to find {} on $PATH".format(command))
 
 def getCommandVersion(path,versionArgs,versionRegex, check=True):
@@ -282,6 +764,9 @@ class Check(object):
         path = getCommandPath(self.command)
         version = getCommandVersion(path,self.versionArgs, self.versionRegex, self.checkVersionExitStatus)
         desc = "{} found at {} (version {})".format(self.command,path,version)
+        shadowed = getPathIndex().shadowed(self.command)
+        if shadowed:
+            desc += ", shadowing {}".format(", ".join(shadowed))
         checkVersions(desc, version, self.minVersion, self.maxVersion)
         return desc
 
@@ -291,21 +776,19 @@ class Check(object):
 class CheckNvm(object):
     """
     Check that a nvm is installed. This needs special logic as its a shell extension
-    and not a program installed on the PATH
+    and not a program installed on the PATH, so we inspect $NVM_DIR directly
     """
     def __init__( self, minVersion, maxVersion):
         self.minVersion = minVersion
         self.maxVersion = maxVersion
 
     def run(self):
-        sp = subprocess.run(['/bin/bash', '-i', '-c', 'nvm --version'], stdout=subprocess.PIPE)
-        if sp.returncode:
-            raise CheckException("nvm not installed into shell")
-        match = re.match("([0-9]+.[0-9]+.([0-9]+)?)", sp.stdout.decode('utf-8'), flags=re.DOTALL)
-        if not match:
+        if not nvmScript():
+            raise CheckException("nvm not installed (no nvm.sh found in {})".format(nvmDir()))
+        version = nvmVersion()
+        if not version:
             raise CheckException("Unable to determine version of nvm")
-        version =  match.group(1)
-        desc = 'nvm installed (version {})'.format(version)
+        desc = 'nvm installed (version {}, node versions: {})'.format(version, ', '.join(nvmNodeVersions()) or 'none')
         checkVersions(desc, version, self.minVersion, self.maxVersion)
         return desc
 
@@ -423,18 +906,67 @@ class BazelDeployJar(object):
         self.dir = Path(dir)
         self.name = name
         self.path = self.rootdir / 'bazel-bin' / self.dir / (self.name + ".jar")
+        self.label = '{}:{}.jar'.format(self.dir,self.name)
 
-def bazel_build_deployjar(target, doc):
+class BazelDeployJarBatch(object):
+    """
+    Shares a single bazel up-to-date check and a single bazel build
+    across a set of deployment jar targets, so that bazel is invoked
+    once per workspace rather than twice per jar, and can parallelize
+    the builds internally. Note that building any one jar in the batch
+    brings every jar in the batch up to date.
+
+    The shared state lives in this process only: under doit -n each
+    worker process performs its own check and batch build.
+    """
+    def __init__(self, targets):
+        self.workspaces = {}
+        for target in targets:
+            self.workspaces.setdefault(target.rootdir, []).append(target.label)
+        self.uptodateResults = {}
+        self.built = set()
+        self.lock = threading.Lock()
+
+    def isUpToDate(self, target):
+        with self.lock:
+            if target.rootdir not in self.uptodateResults:
+                try:
+                    sp = subprocess.run(
+                        ['bazel', 'build', '--check_up_to_date'] + self.workspaces[target.rootdir],
+                        cwd=str(target.rootdir), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    self.uptodateResults[target.rootdir] = sp.returncode == 0
+                except OSError:
+                    # eg bazel not installed: let the build action report it
+                    self.uptodateResults[target.rootdir] = False
+            return self.uptodateResults[target.rootdir]
+
+    def build(self, target):
+        with self.lock:
+            if target.rootdir not in self.built:
+                subprocess.run(['bazel', 'build'] + self.workspaces[target.rootdir], cwd=str(target.rootdir), check=True)
+                self.built.add(target.rootdir)
+                self.uptodateResults[target.rootdir] = True
+
+def bazel_build_deployjar(target, doc, batch=None):
     """
     A doit task to run bazel to build a deployment jar. Relies on
-    bazels dependency analysis for checking if task needs to be run
+    bazels dependency analysis for checking if task needs to be run.
+    If a BazelDeployJarBatch is provided, the check and build are
+    shared with the other jars in the batch.
     """
-    bazeltarget = '{}:{}.jar'.format(target.dir,target.name)
+    if batch:
+        return {
+            'actions': [(batch.build, [target])],
+            'uptodate': [(batch.isUpToDate, [target])],
+            'targets' : [target.path],
+            'clean' : ['cd {}; bazel clean'.format(target.rootdir)],
+            'doc' : doc
+        }
     return {
         'actions': [
-            'cd {}; bazel build {}'.format(target.rootdir,bazeltarget),
+            'cd {}; bazel build {}'.format(target.rootdir,target.label),
         ],
-        'uptodate': ['cd {}; bazel build --check_up_to_date {}'.format(target.rootdir,bazeltarget)],
+        'uptodate': ['cd {}; bazel build --check_up_to_date {}'.format(target.rootdir,target.label)],
         'targets' : [target.path],
         'clean' : ['cd {}; bazel clean'.format(target.rootdir)],
         'doc' : doc
@@ -630,6 +1162,32 @@ def bytesWithReplacements(replacements, bs):
         bs = bs.replace(bytes(fromv,'utf-8'), bytes(tov,'utf-8'))
     return bs
 
+def cacheDir(name):
+    """
+    Return (creating if necessary) a per user cache directory for hx tooling
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.environ['HOME'], '.cache')
+    path = Path(base) / 'hx-terraform' / name
+    os.makedirs(str(path), exist_ok=True)
+    return path
+
+def fileDigest(rootdir, paths, extra=()):
+    """
+    Return a sha256 hex digest over the contents of the given files
+    (and their paths relative to rootdir), together with any extra strings
+    """
+    h = hashlib.sha256()
+    for s in extra:
+        h.update(s.encode('utf-8'))
+        h.update(b'\0')
+    for p in sorted(Path(p).relative_to(rootdir) for p in paths):
+        h.update(str(p).encode('utf-8'))
+        h.update(b'\0')
+        with open(str(Path(rootdir) / p), 'rb') as f:
+            h.update(f.read())
+        h.update(b'\0')
+    return h.hexdigest()
+
 def fileAge(filepath):
     """ Get age of a file in seconds """
     return time.time() - os.path.getmtime(filepath)
@@ -2,11 +2,12 @@ import os
 import io
 import shutil
 import subprocess
+import uuid
 from urllib.request import urlopen
 import zipfile
 import tempfile
 from pathlib import *
-from hx.dodo_helpers import rglobfiles
+from hx.dodo_helpers import rglobfiles, cacheDir, fileDigest
 
 def run_dockerized_terraform(terraform_image, args):
     """
@@ -33,14 +34,79 @@ def run_dockerized_terraform(terraform_image, args):
     cmd += ' '.join(args)
     return cmd
 
+ADLC_IMAGE = 'helixta/hxadl:0.11'
+
 def dockerized_adlc(wdir,rcmd):
     cmd =  "docker run -it --rm "
     cmd += "-v {0}:{0} -w {0} ".format(wdir.absolute())
     cmd += "--user $(id -u):$(id -g) "
-    cmd += "helixta/hxadl:0.11 "
+    cmd += "{} ".format(ADLC_IMAGE)
     cmd += ' '.join(rcmd)
     return cmd
 
+def adlc_cache_dir():
+    return cacheDir('adlc')
+
+def adl_stdlib_files(basedir):
+    """
+    Return the paths of the ADL stdlib files within the adlc image.
+    The listing is cached per image tag, so the container is only
+    needed the first time.
+    """
+    cachefile = adlc_cache_dir() / 'stdlib-{}.txt'.format(ADLC_IMAGE.replace('/','_').replace(':','_'))
+    if cachefile.is_file():
+        with open(str(cachefile)) as f:
+            return f.read().split()
+    out = subprocess.check_output(dockerized_adlc(basedir, [
+        "find", "/opt/lib/adl",  "-name", "'*.adl'"
+    ]), shell=True)
+    adlstdlib = sorted(f.decode('utf-8') for f in out.split())
+    tmpfile = cachefile.with_name(cachefile.name + '.' + str(uuid.uuid4()))
+    with open(str(tmpfile), 'w') as f:
+        f.write('\n'.join(adlstdlib) + '\n')
+    os.replace(str(tmpfile), str(cachefile))
+    return adlstdlib
+
+def generate_adl_typescript(basedir, adldir, outputdir):
+    """
+    Generate typescript from the adl files in adldir into outputdir.
+
+    The generated output is cached keyed on the digest of the adl
+    files, the stdlib listing, the adlc arguments and the adlc image,
+    so adlc is only run when the inputs change.
+    """
+    adlfiles = sorted(adldir.glob('*.adl'))
+    adlstdlib = adl_stdlib_files(basedir)
+    # Modules in subdirectories may be imported via the searchdir,
+    # so all of them contribute to the digest
+    searchfiles = [f for f in rglobfiles(adldir) if f.suffix == '.adl']
+    adlcargs = [
+        "--runtime-dir", 'runtime',
+        "--include-rt",
+        "--include-resolver",
+    ]
+    digest = fileDigest(adldir, searchfiles, [ADLC_IMAGE] + adlcargs + [str(f.relative_to(adldir)) for f in adlfiles] + adlstdlib)
+    cached = adlc_cache_dir() / digest
+    shutil.rmtree(str(outputdir), ignore_errors=True)
+    if cached.is_dir():
+        print( "Using cached typescript ({})".format(digest[:12]))
+        shutil.copytree(str(cached), str(outputdir))
+        return
+    subprocess.check_call(dockerized_adlc(basedir, [
+        "adlc", "typescript ",
+        "--searchdir", str(adldir),
+        "--outputdir", str(outputdir),
+        ] + adlcargs + [str(f) for f in adlfiles] + adlstdlib), shell=True)
+
+    # Populate the cache via a rename so a partial copy is never used
+    tmpdir = cached.with_name(cached.name + '.' + str(uuid.uuid4()))
+    shutil.copytree(str(outputdir), str(tmpdir))
+    try:
+        os.rename(str(tmpdir), str(cached))
+    except OSError:
+        # Another run populated the cache first
+        shutil.rmtree(str(tmpdir), ignore_errors=True)
+
 def update_camus2(basedir):
     """
     Returns a doit task to update the version of the camus2 in this repo
@@ -61,23 +127,10 @@ def update_camus2(basedir):
         print( "Extracting adl...")
         unpackdir = camus2dir/'camus2-{}'.format(version)
         shutil.rmtree(str(camus2dir/'adl'), ignore_errors=True)
-        shutil.rmtree(str(camus2dir/'adl-gen'), ignore_errors=True)
         shutil.move(str(unpackdir/'adl'), str(camus2dir))
         shutil.rmtree(str(unpackdir))
         print( "Generating typescript...")
-        out = subprocess.check_output(dockerized_adlc(basedir, [
-            "find", "/opt/lib/adl",  "-name", "'*.adl'"
-        ]), shell=True);
-        adlstdlib = [f.decode('utf-8') for f in out.split()];
-        subprocess.check_call(dockerized_adlc(basedir, [
-            "adlc", "typescript ",
-            "--searchdir", str(camus2dir/'adl'),
-            "--runtime-dir", 'runtime',
-            "--outputdir", str(camus2dir/'adl-gen'),
-            "--include-rt",
-            "--include-resolver",
-            str(camus2dir/'adl/*.adl')
-        ] + adlstdlib), shell=True)
+        generate_adl_typescript(basedir, camus2dir/'adl', camus2dir/'adl-gen')
 
         with open('typescript/hx-terraform/library/camus2/releaseurl.ts', 'w') as f:
             f.write('export const release_url: string = "https://github.com/helix-collective/camus2/releases/download/{}/camus2.x86_64-linux.gz -O /opt/bin/camus2.gz";\n'.format(version))
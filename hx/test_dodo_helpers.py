@@ -0,0 +1,372 @@
+import os
+import json
+import stat
+import errno
+import shutil
+import zipfile
+import tempfile
+import threading
+import unittest
+import email.parser
+from unittest import mock
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from hx.dodo_helpers import uploadSourceMapsToRollbar, DockerContext, DockerImage, placeFile, zipMemberPath, ExcludeRules
+from hx.dodo_helpers import getCommandPath, getPathIndex, CheckException
+from hx.dodo_helpers import BazelDeployJar, BazelDeployJarBatch
+
+
+class RollbarStandIn(object):
+    """
+    A local http server standing in for the rollbar sourcemap api,
+    recording the multipart fields of each upload
+    """
+    def __init__(self):
+        self.uploads = []
+        self.failUrls = set()
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                msg = email.parser.BytesParser().parsebytes(
+                    b'Content-Type: ' + self.headers['Content-Type'].encode('utf-8') + b'\r\n\r\n' + body)
+                fields = {}
+                for part in msg.get_payload():
+                    fields[part.get_param('name', header='content-disposition')] = part.get_payload(decode=True)
+                standin.uploads.append(fields)
+                status = 500 if fields['minified_url'].decode('utf-8') in standin.failUrls else 200
+                self.send_response(status)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.endpoint = 'http://127.0.0.1:{}/api/1/sourcemap'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestUploadSourceMapsToRollbar(unittest.TestCase):
+    def setUp(self):
+        self.workdir = Path(tempfile.mkdtemp())
+        self.manifest = self.workdir / 'manifest.json'
+        self.standin = RollbarStandIn()
+        self.sourcemaps = []
+        for i in range(20):
+            mapfile = self.workdir / 'app{}.js.map'.format(i)
+            with open(str(mapfile), 'w') as f:
+                f.write('{{"version":3,"file":"app{}.js"}}'.format(i))
+            self.sourcemaps.append( ('https://example.com/app{}.js'.format(i), mapfile) )
+
+    def tearDown(self):
+        self.standin.close()
+        shutil.rmtree(str(self.workdir))
+
+    def upload(self, sourcemaps=None):
+        return uploadSourceMapsToRollbar('token', 'v1', sourcemaps or self.sourcemaps, self.manifest,
+                                         endpoint=self.standin.endpoint, workers=4)
+
+    def test_uploads_all_maps_with_fields(self):
+        self.upload()
+        self.assertEqual(len(self.standin.uploads), 20)
+        byurl = {u['minified_url'].decode('utf-8'): u for u in self.standin.uploads}
+        for minifiedurl, mapfile in self.sourcemaps:
+            fields = byurl[minifiedurl]
+            self.assertEqual(fields['access_token'], b'token')
+            self.assertEqual(fields['version'], b'v1')
+            with open(str(mapfile), 'rb') as f:
+                self.assertEqual(fields['source_map'], f.read())
+
+    def test_skips_unchanged_maps(self):
+        self.assertEqual(len(self.upload()), 20)
+        self.assertEqual(self.upload(), [])
+        self.assertEqual(len(self.standin.uploads), 20)
+
+    def test_reuploads_changed_map(self):
+        self.upload()
+        minifiedurl, mapfile = self.sourcemaps[3]
+        with open(str(mapfile), 'w') as f:
+            f.write('{"version":3,"changed":true}')
+        self.assertEqual(self.upload(), [minifiedurl])
+        self.assertEqual(len(self.standin.uploads), 21)
+        self.assertEqual(self.standin.uploads[-1]['source_map'], b'{"version":3,"changed":true}')
+
+    def test_failed_upload_records_successes_and_raises(self):
+        failurl = self.sourcemaps[5][0]
+        self.standin.failUrls.add(failurl)
+        with self.assertRaises(RuntimeError):
+            self.upload()
+        with open(str(self.manifest)) as f:
+            recorded = json.load(f)['v1']
+        self.assertEqual(set(recorded), set(url for url, _ in self.sourcemaps) - {failurl})
+
+        # Only the failed map is retried
+        self.standin.failUrls.clear()
+        self.assertEqual(self.upload(), [failurl])
+
+
+def writeFile(path, content, mode=None):
+    os.makedirs(str(path.parent), exist_ok=True)
+    with open(str(path), 'w') as f:
+        f.write(content)
+    if mode is not None:
+        os.chmod(str(path), mode)
+
+def readFile(path):
+    with open(str(path)) as f:
+        return f.read()
+
+
+class TestDockerContext(unittest.TestCase):
+    def setUp(self):
+        self.workdir = Path(tempfile.mkdtemp())
+        self.src = self.workdir / 'src'
+        self.ctx = self.workdir / 'ctx'
+        os.makedirs(str(self.ctx))
+
+    def tearDown(self):
+        shutil.rmtree(str(self.workdir))
+
+    def makeZip(self, name, entries):
+        zippath = self.workdir / name
+        with zipfile.ZipFile(str(zippath), 'w') as zf:
+            for entry, content, mode in entries:
+                zinfo = zipfile.ZipInfo(entry)
+                zinfo.external_attr = mode << 16
+                zf.writestr(zinfo, content)
+        return zippath
+
+    def test_later_items_override_earlier(self):
+        writeFile(self.src/'a', 'tree a')
+        writeFile(self.src/'b', 'tree b')
+        writeFile(self.src/'c', 'tree c')
+        writeFile(self.workdir/'other', 'file a')
+        zippath = self.makeZip('z.zip', [('b', 'zip b', 0o644), ('c', 'zip c', 0o644)])
+        context = DockerContext()
+        context.tree(self.src, 'app')
+        context.file(self.workdir/'other', 'app/a')
+        context.ziptree(zippath, 'app')
+        context.fileContent('content c', 'app/c')
+        context.copyTo(self.ctx)
+        self.assertEqual(readFile(self.ctx/'app/a'), 'file a')
+        self.assertEqual(readFile(self.ctx/'app/b'), 'zip b')
+        self.assertEqual(readFile(self.ctx/'app/c'), 'content c')
+
+    def test_never_writes_through_hard_links(self):
+        for i in range(50):
+            writeFile(self.src/'d'/'f{}'.format(i), 'orig')
+        writeFile(self.src/'Dockerfile', 'orig')
+        zippath = self.makeZip('z.zip', [('d/f{}'.format(i), 'zip', 0o644) for i in range(50)])
+        context = DockerContext()
+        context.tree(self.src, '')
+        context.ziptree(zippath, '')
+        context.fileContent('content', 'd/f0')
+        context.copyTo(self.ctx)
+        self.assertEqual(readFile(self.ctx/'d/f1'), 'zip')
+        self.assertEqual(set(readFile(self.src/'d'/'f{}'.format(i)) for i in range(50)), {'orig'})
+
+        image = DockerImage('test', context)
+        image.cmd('FROM scratch')
+        with mock.patch('hx.dodo_helpers.subprocess.run'):
+            image.createImage()
+        self.assertEqual(readFile(self.src/'Dockerfile'), 'orig')
+
+    def test_symlinked_subdir_keeps_contents(self):
+        writeFile(self.workdir/'real'/'f', 'linked')
+        os.makedirs(str(self.src))
+        os.symlink(str(self.workdir/'real'), str(self.src/'link'))
+        context = DockerContext()
+        context.tree(self.src, 't')
+        context.copyTo(self.ctx)
+        self.assertEqual(readFile(self.ctx/'t/link/f'), 'linked')
+        self.assertIn(self.src/'link'/'f', context.file_dep())
+
+    def test_empty_tree_is_created(self):
+        os.makedirs(str(self.src/'empty'/'nested'))
+        os.makedirs(str(self.workdir/'nothing'))
+        context = DockerContext()
+        context.tree(self.src, 't')
+        context.tree(self.workdir/'nothing', 'n')
+        context.copyTo(self.ctx)
+        self.assertTrue((self.ctx/'t/empty/nested').is_dir())
+        self.assertTrue((self.ctx/'n').is_dir())
+
+    def test_zip_unpacking(self):
+        zippath = self.makeZip('z.zip', [
+            ('../../evil', 'evil', 0o644),
+            ('/abs/file', 'abs', 0o644),
+            ('bin/run', '#!/bin/sh', 0o755),
+            ('bin/link', 'run', stat.S_IFLNK | 0o777),
+        ])
+        context = DockerContext()
+        context.ziptree(zippath, 'z')
+        context.copyTo(self.ctx)
+        self.assertEqual(readFile(self.ctx/'z/evil'), 'evil')
+        self.assertEqual(readFile(self.ctx/'z/abs/file'), 'abs')
+        self.assertFalse((self.workdir/'evil').exists())
+        self.assertEqual(stat.S_IMODE(os.stat(str(self.ctx/'z/bin/run')).st_mode), 0o755)
+        self.assertTrue(os.path.islink(str(self.ctx/'z/bin/link')))
+        self.assertEqual(os.readlink(str(self.ctx/'z/bin/link')), 'run')
+
+    def test_zip_member_path(self):
+        self.assertEqual(zipMemberPath('a/b'), Path('a/b'))
+        self.assertEqual(zipMemberPath('../a/./../b'), Path('a/b'))
+        self.assertEqual(zipMemberPath('/etc/passwd'), Path('etc/passwd'))
+
+
+class TestPlaceFile(unittest.TestCase):
+    def setUp(self):
+        self.workdir = Path(tempfile.mkdtemp())
+        self.src = self.workdir / 'src'
+        self.dest = self.workdir / 'dest'
+        writeFile(self.src, 'content', 0o750)
+
+    def tearDown(self):
+        shutil.rmtree(str(self.workdir))
+
+    def test_hard_links_on_same_filesystem(self):
+        self.assertEqual(placeFile(self.src, self.dest), 0)
+        self.assertTrue(os.path.samefile(str(self.src), str(self.dest)))
+
+    def test_replaces_rather_than_writes_through_existing_link(self):
+        other = self.workdir / 'other'
+        writeFile(other, 'other')
+        os.link(str(other), str(self.dest))
+        placeFile(self.src, self.dest)
+        self.assertEqual(readFile(other), 'other')
+        self.assertEqual(readFile(self.dest), 'content')
+
+    def test_reflinks_when_hard_link_fails(self):
+        with mock.patch('hx.dodo_helpers.os.link', side_effect=OSError(errno.EXDEV, 'cross-device')), \
+             mock.patch('hx.dodo_helpers.fcntl.ioctl') as ioctl:
+            self.assertEqual(placeFile(self.src, self.dest), 0)
+        self.assertEqual(ioctl.call_count, 1)
+        self.assertEqual(stat.S_IMODE(os.stat(str(self.dest)).st_mode), 0o750)
+
+    def test_copies_when_links_unsupported(self):
+        with mock.patch('hx.dodo_helpers.os.link', side_effect=OSError(errno.EXDEV, 'cross-device')), \
+             mock.patch('hx.dodo_helpers.fcntl.ioctl', side_effect=OSError(errno.EOPNOTSUPP, 'unsupported')):
+            self.assertEqual(placeFile(self.src, self.dest), len('content'))
+        self.assertFalse(os.path.samefile(str(self.src), str(self.dest)))
+        self.assertEqual(readFile(self.dest), 'content')
+        self.assertEqual(stat.S_IMODE(os.stat(str(self.dest)).st_mode), 0o750)
+
+
+class TestExcludeRules(unittest.TestCase):
+    def test_star_does_not_cross_directories(self):
+        rules = ExcludeRules(['*/cache'])
+        self.assertTrue(rules.excludes('a/cache'))
+        self.assertTrue(rules.excludes('a/cache/file'))
+        self.assertFalse(rules.excludes('a/b/cache'))
+        self.assertFalse(rules.excludes('cache'))
+
+    def test_double_star_matches_any_depth(self):
+        rules = ExcludeRules(['**/cache'])
+        self.assertTrue(rules.excludes('cache'))
+        self.assertTrue(rules.excludes('a/cache'))
+        self.assertTrue(rules.excludes('a/b/cache/file'))
+        self.assertFalse(rules.excludes('a/cached'))
+
+    def test_patterns_are_anchored_at_root(self):
+        rules = ExcludeRules(['*.pyc'])
+        self.assertTrue(rules.excludes('x.pyc'))
+        self.assertFalse(rules.excludes('lib/x.pyc'))
+        self.assertFalse(rules.excludes('x.pyc.txt'))
+
+    def test_directory_contents(self):
+        rules = ExcludeRules(['docs/**'])
+        self.assertTrue(rules.excludes('docs/a'))
+        self.assertTrue(rules.excludes('docs/a/b.md'))
+        self.assertFalse(rules.excludes('mydocs/a'))
+
+    def test_negation_last_match_wins(self):
+        rules = ExcludeRules(['*.log', '!keep.log'])
+        self.assertTrue(rules.excludes('a.log'))
+        self.assertFalse(rules.excludes('keep.log'))
+        rules = ExcludeRules(['!keep.log', '*.log'])
+        self.assertTrue(rules.excludes('keep.log'))
+
+    def test_bracket_classes(self):
+        rules = ExcludeRules(['[a-c]x', '[!0-9]y', '[\\]z'])
+        self.assertTrue(rules.excludes('bx'))
+        self.assertFalse(rules.excludes('dx'))
+        self.assertTrue(rules.excludes('ay'))
+        self.assertFalse(rules.excludes('1y'))
+        self.assertTrue(rules.excludes('\\z'))
+        self.assertFalse(rules.excludes('az'))
+
+    def test_empty_and_unterminated_brackets_are_literal(self):
+        rules = ExcludeRules(['[]', 'a[b'])
+        self.assertTrue(rules.excludes('[]'))
+        self.assertTrue(rules.excludes('a[b'))
+        self.assertFalse(rules.excludes('ab'))
+
+    def test_excludes_apply_to_file_dep_and_copy(self):
+        workdir = Path(tempfile.mkdtemp())
+        try:
+            writeFile(workdir/'src'/'keep.py', 'keep')
+            writeFile(workdir/'src'/'.git'/'HEAD', 'git')
+            writeFile(workdir/'src'/'lib'/'x.pyc', 'pyc')
+            context = DockerContext()
+            context.tree(workdir/'src', 'app', exclude=['.git', '**/*.pyc'])
+            self.assertEqual(context.file_dep(), [workdir/'src'/'keep.py'])
+            context.copyTo(workdir/'ctx')
+            self.assertTrue((workdir/'ctx/app/keep.py').is_file())
+            self.assertFalse((workdir/'ctx/app/.git').exists())
+            self.assertFalse((workdir/'ctx/app/lib/x.pyc').exists())
+        finally:
+            shutil.rmtree(str(workdir))
+
+
+class TestPathIndex(unittest.TestCase):
+    def setUp(self):
+        self.workdir = Path(tempfile.mkdtemp())
+        self.dirs = [self.workdir/'a', self.workdir/'b']
+        for d in self.dirs:
+            os.makedirs(str(d))
+        path = os.pathsep.join(str(d) for d in self.dirs)
+        self.env = mock.patch.dict(os.environ, {'PATH': path})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(str(self.workdir))
+
+    def test_finds_first_executable_and_reports_shadowed(self):
+        writeFile(self.dirs[0]/'tool', '', 0o755)
+        writeFile(self.dirs[1]/'tool', '', 0o755)
+        writeFile(self.dirs[0]/'data', '', 0o644)
+        self.assertEqual(getCommandPath('tool'), str(self.dirs[0]/'tool'))
+        self.assertEqual(getPathIndex().shadowed('tool'), [str(self.dirs[1]/'tool')])
+        with self.assertRaises(CheckException):
+            getCommandPath('data')
+
+    def test_finds_command_installed_after_index_built(self):
+        getPathIndex()
+        writeFile(self.dirs[1]/'late', '', 0o755)
+        self.assertEqual(getCommandPath('late'), str(self.dirs[1]/'late'))
+
+
+class TestBazelDeployJarBatch(unittest.TestCase):
+    def test_missing_bazel_is_not_up_to_date(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            jar = BazelDeployJar(workdir, 'a/b', 'app')
+            batch = BazelDeployJarBatch([jar])
+            with mock.patch.dict(os.environ, {'PATH': workdir}):
+                self.assertFalse(batch.isUpToDate(jar))
+        finally:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    unittest.main()